@@ -13,171 +13,350 @@
 # of the MIT license.  See the LICENSE file for details.
 
 import argparse
+import collections
+import csv
+import functools
+import gc
+import hashlib
 import json
+import mmap
 import os
-import subprocess
 import pickle
 import sys
-import ntpath
-from threading import Lock
-from multiprocessing.pool import ThreadPool as Pool
-import xml.etree.ElementTree as ET
-import urllib.request
+import concurrent.futures
+import plistlib
+import urllib.parse
 import platform
-
-checksums_dict = {}
-checksums_dict_lock = Lock()
+import posixpath
+import re
+import stat
+
+try:
+    # xxh3 is several times faster than blake2b, but isn't required
+    import xxhash
+    new_hash = xxhash.xxh3_128
+    hash_name = 'xxh3_128'
+except ImportError:
+    new_hash = functools.partial(hashlib.blake2b, digest_size=16)
+    hash_name = 'blake2b_128'
+
+checksums_dict = collections.defaultdict(list)
 file_path_dict = {}
-file_path_dict_lock = Lock()
+hash_db = {}  # (hash_name, st_dev, st_ino, st_size, st_mtime_ns) -> checksums, persisted between runs
+hash_db_seen = set()  # hash_db keys of the files walked this run
 
-pool_size = 5  # your "parallelness"
-pool = Pool(pool_size)
+READ_BUF = 1 << 20  # bytes read per call while hashing a file
+WRITE_BUF = 1 << 20  # buffer size for each report file
+HEAD_SIZE = 1 << 16  # bytes hashed to rule out same-size files before hashing them in full
+pool_size = os.cpu_count()  # your "parallelness"
+batch_size = 256  # files hashed per worker task
+strip_file_url = re.compile(r'^file://(?:localhost)?').sub  # iTunes Location URL -> quoted path
+media_extensions = {'.aac', '.aif', '.aiff', '.m4a', '.m4b', '.m4p', '.m4v', '.mp3', '.mp4', '.wav'}  # everything else is skipped
 
 
 class FileAttributes:
+    # One of these exists per file and per track, so skip the per-instance __dict__
+    __slots__ = ('file_path', 'file_name', 'head_checksum', 'checksum', 'itunes_key', 'itunes_file_path')
+
     def __init__(self):
         self.file_path=None
         self.file_name=None
+        self.head_checksum=None
         self.checksum=None
         self.itunes_key=-1
         self.itunes_file_path=None
 
 
-def path_leaf(path):
-    ''' Taken from https://stackoverflow.com/questions/8384737/extract-file-name-from-path-no-matter-what-the-os-path-format'''
-    head, tail = ntpath.split(path)
-    return tail or ntpath.basename(head)
+def checksum_file(filename):
+    ''' Hash the file in-process, rather than forking a cksum process for every file '''
+    file_hash = new_hash()
+    with open(filename, 'rb', buffering=0) as fh:
+        file_size = os.fstat(fh.fileno()).st_size
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fh.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        if file_size >= READ_BUF:
+            # Large files are mapped so the hash reads straight from the page cache
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                with memoryview(mm) as view:
+                    file_hash.update(view)
+        else:
+            while True:
+                chunk = fh.read(READ_BUF)
+                if not chunk:
+                    break
+                file_hash.update(chunk)
+        if hasattr(os, 'posix_fadvise'):
+            # Don't let a full library scan evict everything else from the page cache
+            os.posix_fadvise(fh.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    return file_hash.digest()
+
+
+def head_hash(filename):
+    ''' Hash only the first HEAD_SIZE bytes of the file '''
+    with open(filename, 'rb', buffering=0) as fh:
+        head = new_hash()
+        head.update(fh.read(HEAD_SIZE))
+        return head.digest()
+
+
+def process_file(file_name, head_only=False):
+    ''' Runs in a worker process; the results are merged into file_path_dict by the parent '''
+    print( "<<<" + file_name + ">>>" )
+    file_cksum = None
+    try:
+        file_cksum = head_hash(file_name) if head_only else checksum_file(file_name)
+    except Exception as detail:
+        print( 'Exception while hashing ' + file_name + ': ' + str(detail) )
+    return file_name, file_cksum
 
 
-def checksum_file(filename):
-    result = subprocess.check_output(['cksum', filename])
-    checksum = result.split(' ')[0]
-    return checksum
+def process_file_batch(file_names, head_only=False):
+    ''' Hash a whole batch per task so dispatch and pickling cost is paid per batch, not per file '''
+    results = {}
+    for file_name in file_names:
+        file_path, file_cksum = process_file(file_name, head_only)
+        results[file_path] = file_cksum
+    return results
 
 
-def process_file(file_name):
-    print( "<<<" + file_name + ">>>" )
-    file_cksum = checksum_file(file_name)
+def chunks_of(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def walk_files(walk_dir):
+    ''' Yields (file_path, file_name, stat_result) for every file under walk_dir, using the name and stat that scandir caches.
+    Symlinks are yielded with their own stat rather than followed '''
+    try:
+        with os.scandir(walk_dir) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        yield from walk_files(entry.path)
+                    else:
+                        yield entry.path, entry.name, entry.stat(follow_symlinks=False)
+                except OSError as detail:
+                    print( 'Exception: ' + str(detail) )
+    except OSError as detail:
+        print( 'Exception: ' + str(detail) )
+
+
+def worth_hashing(file_name, st):
+    ''' Symlinks, empty files, hidden files such as .DS_Store and anything that isn't media
+    are kept in the inventory but never hashed '''
+    return (stat.S_ISREG(st.st_mode) and st.st_size > 0 and not file_name.startswith('.') and
+            os.path.splitext(file_name)[1].lower() in media_extensions)
+
+
+def hash_db_key(st):
+    ''' hash_db maps this key to a (head_checksum, checksum, file_path) tuple; either checksum may be None.
+    The hash name is part of the key so digests from different hash functions never get compared '''
+    return hash_name, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns
+
+
+def load_hash_db(hash_db_file):
+    try:
+        if os.path.exists(hash_db_file):
+            print( 'Loading file hash database from: ' + hash_db_file )
+            with open(hash_db_file, 'rb') as fh:
+                hash_db.update(pickle.load(fh))
+    except Exception as detail:
+        print( 'Exception while loading file hash database from ' + hash_db_file + ' ' + str(detail) )
+
+
+def save_hash_db(hash_db_file, walk_dir):
+    try:
+        print( 'Saving file hash database to ' + hash_db_file )
+        # An entry under walk_dir that wasn't seen this run belongs to a file that has been deleted,
+        # moved or retagged since. Entries outside walk_dir weren't checked, so they are all kept
+        walk_prefix = os.path.join(os.path.abspath(walk_dir), '')
+        live_entries = {key: entry for key, entry in hash_db.items()
+                        if key in hash_db_seen or not entry[2].startswith(walk_prefix)}
+        with open(hash_db_file, 'wb') as fh:
+            pickle.dump(live_entries, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception as detail:
+        print( 'Exception: ' + str(detail) )
+
+
+def add_file(file_path, file_name, head_cksum, file_cksum):
     new_file = FileAttributes()
-    new_file.file_path = file_name
-    new_file.file_name = path_leaf(file_name)
+    new_file.file_path = file_path
+    new_file.file_name = file_name
+    new_file.head_checksum = head_cksum
     new_file.checksum = file_cksum
-    file_path_dict_lock.acquire()
-    try:
-        file_path_dict[file_name] = new_file
-    finally:
-        file_path_dict_lock.release()
+    file_path_dict[file_path] = new_file
+    # Index by checksum as files arrive, rather than with a second pass over file_path_dict
+    if file_cksum is not None:
+        checksums_dict[file_cksum].append(new_file)
+
+
+def hash_files(executor, files, head_only):
+    ''' Yields (file_path, file_name, st, checksum) for each (file_path, file_name, st) in files.
+    Only files that are new or have changed since the last run get sent to the workers '''
+    field = 0 if head_only else 1
+    pending = {}
+    for file_path, file_name, st in files:
+        cached = hash_db.get(hash_db_key(st), (None, None, None))[field]
+        if cached is not None:
+            yield file_path, file_name, st, cached
+        else:
+            pending[file_path] = (file_name, st)
+
+    batch_func = functools.partial(process_file_batch, head_only=head_only)
+    for results in executor.map(batch_func, chunks_of(list(pending), batch_size)):
+        for file_path, file_cksum in results.items():
+            file_name, st = pending[file_path]
+            if file_cksum is not None:
+                key = hash_db_key(st)
+                entry = list(hash_db.get(key, (None, None, None)))
+                entry[field] = file_cksum
+                entry[2] = os.path.abspath(file_path)
+                hash_db[key] = tuple(entry)
+            yield file_path, file_name, st, file_cksum
 
 
 def calculate_all_checksums(walk_dir):
     print( '--\n--Calculating File Checksums (This will take a LOOOOONG time)\n--')
-    for root, subdirs, files in os.walk(walk_dir):
-        for file in files:
-            pool.apply_async(process_file, (os.path.join(root, file),))
-    pool.close()
-    pool.join()
+    # A file whose size is unique can't have a duplicate, so only size collisions need hashing
+    size_groups = collections.defaultdict(list)
+    for file_path, file_name, st in walk_files(walk_dir):
+        if worth_hashing(file_name, st):
+            hash_db_seen.add(hash_db_key(st))
+            size_groups[st.st_size].append((file_path, file_name, st))
+        else:
+            add_file(file_path, file_name, None, None)
+
+    head_candidates = []
+    for group in size_groups.values():
+        if len(group) == 1:
+            file_path, file_name, st = group[0]
+            add_file(file_path, file_name, None, None)
+        else:
+            head_candidates.extend(group)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=pool_size) as executor:
+        # Most same-size files already differ in their first few KiB, so compare those first
+        head_groups = collections.defaultdict(list)
+        for file_path, file_name, st, head_cksum in hash_files(executor, head_candidates, head_only=True):
+            head_groups[(st.st_size, head_cksum)].append((file_path, file_name, st))
+
+        head_checksums = {}
+        full_candidates = []
+        for (file_size, head_cksum), group in head_groups.items():
+            for file_path, file_name, st in group:
+                if len(group) == 1 or head_cksum is None:
+                    add_file(file_path, file_name, head_cksum, None)
+                elif file_size <= HEAD_SIZE:
+                    # The head hash already covered the whole file
+                    add_file(file_path, file_name, head_cksum, head_cksum)
+                else:
+                    head_checksums[file_path] = head_cksum
+                    full_candidates.append((file_path, file_name, st))
+
+        for file_path, file_name, st, file_cksum in hash_files(executor, full_candidates, head_only=False):
+            add_file(file_path, file_name, head_checksums[file_path], file_cksum)
+
+def add_itunes_track(this_dict):
+    try:
+        unquoted_path = urllib.parse.unquote(strip_file_url('', this_dict['Location']))
+        print( this_dict['Name'], this_dict['Location'], unquoted_path )
+        if unquoted_path not in file_path_dict:
+            print( 'WARNING: ' + unquoted_path + ' was in iTunes Library, but not in file system' )
+            file_path_dict[unquoted_path] = FileAttributes()
+            file_path_dict[unquoted_path].file_name = posixpath.basename(unquoted_path)
+        file_path_dict[unquoted_path].itunes_file_path = unquoted_path
+        file_path_dict[unquoted_path].itunes_key = this_dict.get('Track ID', -1)
+    except Exception as detail:
+        print( 'Exception: ' + str(detail) )
+
 
 def read_itunes_library(xml_file):
     try:
-        xml_tree = ET.parse(xml_file)
-        xml_root = xml_tree.getroot()
-
-        cur_key = -1
-
-        for this_node in xml_root.findall("./dict/dict/dict"):
-            for data in this_node.iter():
-                if data.tag == 'key':
-                    cur_key = data.text
-                elif data.tag == 'dict':
-                    this_dict = {}
-                    sub_key = ''
-                    for attribute in data.iter():
-                        if attribute.tag == 'key':
-                            sub_key = attribute.text
-                        else:
-                            this_dict[sub_key] = attribute.text
-                        # print 'data6\t\t\t\t', sub_key, attribute.tag, attribute.text, attribute.attrib
-                    try:
-                        unquoted_path = urllib.request.unquote(this_dict['Location']).replace('file://','')
-                        print( this_dict['Name'], this_dict['Location'], unquoted_path )
-                        file_path_dict_lock.acquire()
-                        try:
-                            if unquoted_path not in file_path_dict:
-                                print( 'WARNING: ' + unquoted_path + ' was in iTunes Library, but not in file system' )
-                                file_path_dict[unquoted_path] = FileAttributes()
-                            file_path_dict[unquoted_path].itunes_file_path = unquoted_path
-                            file_path_dict[unquoted_path].itunes_key = cur_key
-                        except Exception as detail:
-                            print( 'Exception: ' + str(detail) )
-                        finally:
-                            file_path_dict_lock.release()
-                    except Exception as detail:
-                        print( 'Exception: ' + str(detail) )
+        # The library export is an Apple plist, so plistlib turns it straight into dicts
+        with open(xml_file, 'rb') as fh:
+            library = plistlib.load(fh)
+        for track in library.get('Tracks', {}).values():
+            add_itunes_track(track)
 
     except Exception as detail:
         print( 'Exception: ' + str(detail) )
         return
 
+def open_report(file_path):
+    return open(file_path, 'w', newline='', buffering=WRITE_BUF)
+
+
+def report_writer(fh):
+    # Every field is quoted, as the reports always have been
+    return csv.writer(fh, quoting=csv.QUOTE_ALL, lineterminator='\n')
+
+
 def generate_reports(report_path):
     if not os.path.exists(report_path):
         os.mkdir(report_path)
-    create_dupes_map()
 
-    with open(report_path + 'not_in_itunes.csv', 'w') as fh_not_in_itunes_db, \
-            open(report_path + 'not_in_itunes.csv', 'w') as fh_missing_file, \
-            open(report_path + 'file_in_itunes.csv', 'w') as fh_file_in_itunes_db, \
-            open(report_path + 'dupe_file_orig_in_itunes.csv', 'w') as fh_dupe_file_orig_in_itunes:
+    with open_report(report_path + 'not_in_itunes.csv') as fh_not_in_itunes_db, \
+            open_report(report_path + 'missing_file.csv') as fh_missing_file, \
+            open_report(report_path + 'file_in_itunes.csv') as fh_file_in_itunes_db, \
+            open_report(report_path + 'dupe_file_orig_in_itunes.csv') as fh_dupe_file_orig_in_itunes:
+        not_in_itunes_db = report_writer(fh_not_in_itunes_db)
+        missing_file = report_writer(fh_missing_file)
+        file_in_itunes_db = report_writer(fh_file_in_itunes_db)
+        dupe_file_orig_in_itunes = report_writer(fh_dupe_file_orig_in_itunes)
 
-        file_path_dict_lock.acquire()
         temp = None
         try:
             for file_name, file_data in file_path_dict.items():
                 temp = file_data
                 if file_data.itunes_file_path is None:
-                    fh_not_in_itunes_db.write('"' + file_data.file_name + '","' + file_data.file_path + '"\n')
+                    not_in_itunes_db.writerow([file_data.file_name, file_data.file_path])
                 elif file_data.file_path is None:
-                    fh_missing_file.write('"' + path_leaf(file_data.itunes_file_path) + '","' + file_data.itunes_file_path + '"\n')
+                    missing_file.writerow([file_data.file_name, file_data.itunes_file_path])
                 else:
-                    fh_file_in_itunes_db.write('"' + file_data.file_name + '","' + file_data.file_path + '"\n')
+                    file_in_itunes_db.writerow([file_data.file_name, file_data.file_path])
         except Exception as details:
-            print( 'Exception: ' + details.message )
-        finally:
-            file_path_dict_lock.release()
+            print( 'Exception: ' + str(details) )
 
 
         # Search through duplicate files and create list of those that have a copy in iTunes
         try:
             for checksum, file_data_array in checksums_dict.items():
                 temp = file_data_array
-                # If there are multiple files with the same checksum
-                if file_data_array.len() > 1:
-                    file_in_itunes = None
-                    # Try to find the file in iTunes
-                    for cur_file in file_data_array:
-                        if cur_file.itunes_file_path is not None:
-                            if file_in_itunes is not None:
-                                print( 'Duplicate files found in the iTunes library: ' + file_in_itunes.file_name + " and " + cur_file.itunes_file_path )
-                            file_in_itunes = cur_file
-                    for cur_file in file_data_array:
-                        if file_in_itunes is None:
-                            print( cur_file.file_path + ' is a duplicate, but does not have a copy in iTunes DB' )
-                        elif file_in_itunes is not cur_file:
-                            fh_dupe_file_orig_in_itunes.write('"' + cur_file.file_name + '","' + cur_file.file_path + '"')
-        except:
-            print( 'Exception while looking for duplicate files: ' + details.message )
-
-def create_dupes_map():
-    file_path_dict_lock.acquire()
-    try:
-        for file_name, file_data in file_path_dict.items():
-            if file_data.checksum is not None:
-                if not file_data.checksum in checksums_dict:
-                    checksums_dict[file_data.checksum] = []
-                checksums_dict[file_data.checksum].append(file_data)
-    except Exception as details:
-        print( 'Exception: ' + details.message )
-    finally:
-        file_path_dict_lock.release()
+                # Only files that share a checksum with another file are duplicates
+                if len(file_data_array) < 2:
+                    continue
+                file_in_itunes = None
+                # Try to find the file in iTunes
+                for cur_file in file_data_array:
+                    if cur_file.itunes_file_path is not None:
+                        if file_in_itunes is not None:
+                            print( 'Duplicate files found in the iTunes library: ' + file_in_itunes.file_name + " and " + cur_file.itunes_file_path )
+                        file_in_itunes = cur_file
+                for cur_file in file_data_array:
+                    if file_in_itunes is None:
+                        print( cur_file.file_path + ' is a duplicate, but does not have a copy in iTunes DB' )
+                    elif file_in_itunes is not cur_file:
+                        dupe_file_orig_in_itunes.writerow([cur_file.file_name, cur_file.file_path])
+        except Exception as details:
+            print( 'Exception while looking for duplicate files: ' + str(details) )
+
+
+def cache_columns():
+    ''' Lay file_path_dict out as one list per attribute, which pickles far smaller than an object per file '''
+    columns = {'key': list(file_path_dict)}
+    for attr in FileAttributes.__slots__:
+        columns[attr] = [getattr(file_data, attr) for file_data in file_path_dict.values()]
+    return columns
+
+
+def restore_from_columns(columns):
+    for i, key in enumerate(columns['key']):
+        file_data = FileAttributes()
+        for attr in FileAttributes.__slots__:
+            setattr(file_data, attr, columns[attr][i])
+        file_path_dict[key] = file_data
+        if file_data.checksum is not None:
+            checksums_dict[file_data.checksum].append(file_data)
 
 
 if __name__ == "__main__":
@@ -189,6 +368,8 @@ if __name__ == "__main__":
     parser.add_argument('--cache', dest='cache_file', default='',
                         help='Optional cache file to load the internal data of this tool (for debugging use, when you' +
                              'don\'t want to re-parse all of the data')
+    parser.add_argument('--hashdb', dest='hash_db_file', default='hashdb.pkl',
+                        help='File hash database, used to skip re-hashing files that have not changed since the last run')
     try:
         # allow command line arguments to be commented out by starting with #
         good_args = []
@@ -200,6 +381,7 @@ if __name__ == "__main__":
         walk_dir = args.itunes_dir
         xml_file = args.xml_file
         cache_file = args.cache_file
+        hash_db_file = args.hash_db_file
     except Exception as detail:
         print( 'Exception: ' + str(detail) )
         parser.print_help()
@@ -222,21 +404,28 @@ if __name__ == "__main__":
     print( 'iTunes Library root directory: ' + walk_dir )
     print( 'XML Library file: ' + xml_file )
     if cache_file == '' or not os.path.exists(cache_file):
+        load_hash_db(hash_db_file)
         calculate_all_checksums(walk_dir)
+        save_hash_db(hash_db_file, walk_dir)
         read_itunes_library(xml_file)
         try:
             if not cache_file:
                 cache_file = xml_file.replace('.xml', '.pkl').replace(' ', '_')
             print( 'Saving cached data to ' + cache_file )
             with open(cache_file, 'wb') as fh:
-                pickle.dump(file_path_dict, fh)
+                pickle.dump(cache_columns(), fh, protocol=pickle.HIGHEST_PROTOCOL)
         except Exception as detail:
             print( 'Exception: ' + str(detail) )
     else:
         try:
             print( 'Loading cached data from: ' + cache_file )
-            with open(cache_file, 'rb') as cache_fh:
-                file_path_dict = pickle.load(cache_fh)
+            # Loading creates a lot of objects; don't let the garbage collector keep rescanning them
+            gc.disable()
+            try:
+                with open(cache_file, 'rb') as cache_fh:
+                    restore_from_columns(pickle.load(cache_fh))
+            finally:
+                gc.enable()
         except Exception as detail:
             print( 'Exception while loading cached data from ' + cache_file + ' ' + str(detail) )
             exit(-1)